@@ -1,17 +1,19 @@
 import asyncio
 import base64
+import functools
 import mimetypes
 import os
 import re
-import uuid
+import secrets
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 import httpx
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
@@ -28,6 +30,11 @@ load_dotenv(BASE_DIR / ".env")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
 DEFAULT_MODEL = os.getenv("IMAGE_MODEL", os.getenv("SORA_MODEL", "gpt-image-1"))
+GLOBAL_CONCURRENCY = max(1, int(os.getenv("GLOBAL_CONCURRENCY", "20")))
+OPENAI_HEADERS = {"Authorization": f"Bearer {OPENAI_API_KEY}"} if OPENAI_API_KEY else None
+
+_INVALID_BASE_RE = re.compile(r'[<>:"/\\|?*]')
+_WS_RE = re.compile(r"\s+")
 
 
 @dataclass
@@ -42,10 +49,11 @@ class JobRecord:
     api_status: str | None = None
     revised_prompt: str | None = None
     output_path: str | None = None
+    output_ready: bool = False
     error: str | None = None
 
     def to_dict(self) -> dict[str, Any]:
-        output_exists = bool(self.output_path and Path(self.output_path).exists())
+        output_exists = self.output_ready
         file_url = f"/api/batches/{self.batch_id}/jobs/{self.id}/download" if output_exists else None
         return {
             "id": self.id,
@@ -68,6 +76,7 @@ class BatchRecord:
     prompts: list[str]
     image_filenames: list[str]
     jobs: list[JobRecord] = field(default_factory=list)
+    jobs_by_id: dict[str, JobRecord] = field(default_factory=dict)
     status: str = "queued"
     model: str = DEFAULT_MODEL
     size: str = "1024x1024"
@@ -75,8 +84,10 @@ class BatchRecord:
     output_format: str = "png"
     concurrency: int = 1
     error: str | None = None
+    status_counts: dict[str, int] = field(default_factory=dict, init=False)
+    _cached_json: bytes | None = field(default=None, init=False, repr=False)
 
-    def counts(self) -> dict[str, int]:
+    def __post_init__(self) -> None:
         counts = {
             "total": len(self.jobs),
             "queued": 0,
@@ -87,10 +98,30 @@ class BatchRecord:
         }
         for job in self.jobs:
             counts[job.status] = counts.get(job.status, 0) + 1
-        return counts
+        self.status_counts = counts
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.status_counts)
+
+    def invalidate(self) -> None:
+        self._cached_json = None
+
+    def to_json(self) -> bytes:
+        # Polling clients get the same bytes until a job or batch field changes.
+        if self._cached_json is None:
+            self._cached_json = orjson.dumps(self.to_dict())
+        return self._cached_json
+
+    def move_job_status(self, old_status: str, new_status: str) -> None:
+        if old_status == new_status:
+            return
+        self.status_counts[old_status] = self.status_counts.get(old_status, 0) - 1
+        self.status_counts[new_status] = self.status_counts.get(new_status, 0) + 1
 
     def recalculate_status(self) -> None:
-        counts = self.counts()
+        self.recalculate_status_from(self.status_counts)
+
+    def recalculate_status_from(self, counts: dict[str, int]) -> None:
         if counts["total"] == 0:
             self.status = "queued"
             return
@@ -109,7 +140,8 @@ class BatchRecord:
         self.status = "running"
 
     def to_dict(self) -> dict[str, Any]:
-        self.recalculate_status()
+        counts = self.counts()
+        self.recalculate_status_from(counts)
         return {
             "id": self.id,
             "status": self.status,
@@ -121,41 +153,92 @@ class BatchRecord:
             "image_count": len(self.image_filenames),
             "prompt_count": len(self.prompts),
             "combination_count": len(self.jobs),
-            "counts": self.counts(),
+            "counts": counts,
             "error": self.error,
             "jobs": [job.to_dict() for job in self.jobs],
         }
 
 
-app = FastAPI(title="MSE Image Bulk Runner")
+# Condition-based limiter; unlike asyncio.Semaphore its cap can be lowered while jobs are running.
+class _Admission:
+    def __init__(self, cap: int) -> None:
+        self.cap = max(1, cap)
+        self.active = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.cap)
+            self.active += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify(1)
+
+    async def resize(self, new_cap: int) -> None:
+        async with self._condition:
+            self.cap = max(1, new_cap)
+            self._condition.notify_all()
+
+    async def __aenter__(self) -> "_Admission":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.release()
+
+
+app = FastAPI(title="MSE Image Bulk Runner", default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
 state_lock = asyncio.Lock()
 batches: dict[str, BatchRecord] = {}
+# Caps in-flight API calls across all batches; waits happen here rather than in httpx's pool.
+GLOBAL_API_SEM = asyncio.Semaphore(GLOBAL_CONCURRENCY)
+HTTP_CLIENT: httpx.AsyncClient | None = None
+
+
+@app.on_event("startup")
+async def _startup() -> None:
+    # One pooled HTTP/2 client for the whole process so concurrent image edits share connections.
+    global HTTP_CLIENT
+    HTTP_CLIENT = httpx.AsyncClient(
+        base_url=OPENAI_BASE_URL,
+        timeout=httpx.Timeout(180.0),
+        limits=httpx.Limits(
+            max_connections=GLOBAL_CONCURRENCY,
+            max_keepalive_connections=GLOBAL_CONCURRENCY,
+        ),
+        http2=True,
+        headers=OPENAI_HEADERS,
+    )
 
 
-def _openai_headers() -> dict[str, str]:
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY is not set")
-    return {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    global HTTP_CLIENT
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
 
 
-def _guess_content_type(filename: str) -> str:
-    guessed, _ = mimetypes.guess_type(filename)
+@functools.lru_cache(maxsize=64)
+def _content_type_for_ext(ext: str) -> str:
+    guessed, _ = mimetypes.guess_type(f"file{ext}")
     return guessed or "application/octet-stream"
 
 
-async def _create_image_edit(job: JobRecord, batch: BatchRecord) -> tuple[bytes, str | None]:
-    image_path = Path(job.image_path)
-    file_bytes = image_path.read_bytes()
-    files = {
-        "image": (
-            job.image_filename,
-            file_bytes,
-            _guess_content_type(job.image_filename),
-        )
-    }
+def _guess_content_type(filename: str) -> str:
+    return _content_type_for_ext(os.path.splitext(filename)[1].lower())
+
+
+async def _create_image_edit(
+    job: JobRecord,
+    batch: BatchRecord,
+    on_rate_limited: Callable[[], Awaitable[None]] | None = None,
+) -> tuple[bytes, str | None]:
     data = {
         "model": batch.model,
         "prompt": job.prompt,
@@ -165,31 +248,48 @@ async def _create_image_edit(job: JobRecord, batch: BatchRecord) -> tuple[bytes,
         "n": "1",
     }
 
-    async with httpx.AsyncClient(timeout=180.0) as client:
-        response = await client.post(
-            f"{OPENAI_BASE_URL}/images/edits",
-            headers=_openai_headers(),
-            data=data,
-            files=files,
-        )
-        if response.status_code >= 400:
-            raise RuntimeError(f"Image edit failed ({response.status_code}): {response.text[:500]}")
-
-        payload = response.json()
-        data_items = payload.get("data") or []
-        if not data_items:
-            raise RuntimeError("Image edit response did not include image data.")
-
-        image_item = data_items[0]
-        b64_json = image_item.get("b64_json")
-        if not b64_json:
-            raise RuntimeError("Image edit response did not include b64_json output.")
-        try:
-            image_bytes = base64.b64decode(b64_json)
-        except Exception as exc:  # noqa: BLE001
-            raise RuntimeError("Failed to decode returned image data.") from exc
+    if OPENAI_HEADERS is None:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    if HTTP_CLIENT is None:
+        raise RuntimeError("HTTP client is not initialized.")
+    # Pass an open file handle so httpx streams the upload instead of buffering the whole image.
+    image_file = open(job.image_path, "rb")
+    try:
+        files = {
+            "image": (
+                job.image_filename,
+                image_file,
+                _guess_content_type(job.image_filename),
+            )
+        }
+        async with GLOBAL_API_SEM:
+            response = await HTTP_CLIENT.post(
+                "/images/edits",
+                data=data,
+                files=files,
+            )
+    finally:
+        image_file.close()
+    if response.status_code == 429 and on_rate_limited is not None:
+        await on_rate_limited()
+    if response.status_code >= 400:
+        raise RuntimeError(f"Image edit failed ({response.status_code}): {response.text[:500]}")
+
+    payload = await asyncio.to_thread(response.json)
+    data_items = payload.get("data") or []
+    if not data_items:
+        raise RuntimeError("Image edit response did not include image data.")
+
+    image_item = data_items[0]
+    b64_json = image_item.get("b64_json")
+    if not b64_json:
+        raise RuntimeError("Image edit response did not include b64_json output.")
+    try:
+        image_bytes = await asyncio.to_thread(base64.b64decode, b64_json)
+    except Exception as exc:  # noqa: BLE001
+        raise RuntimeError("Failed to decode returned image data.") from exc
 
-        return image_bytes, image_item.get("revised_prompt")
+    return image_bytes, image_item.get("revised_prompt")
 
 
 async def _update_job(batch_id: str, job_id: str, **changes: Any) -> None:
@@ -197,27 +297,32 @@ async def _update_job(batch_id: str, job_id: str, **changes: Any) -> None:
         batch = batches.get(batch_id)
         if not batch:
             return
-        job = next((j for j in batch.jobs if j.id == job_id), None)
+        job = batch.jobs_by_id.get(job_id)
         if not job:
             return
+        if "status" in changes:
+            batch.move_job_status(job.status, changes["status"])
         for key, value in changes.items():
             setattr(job, key, value)
         batch.recalculate_status()
+        batch.invalidate()
+
 
+async def _run_job(batch: BatchRecord, job: JobRecord, admission: _Admission) -> None:
+    async def _back_off() -> None:
+        await admission.resize(admission.cap - 1)
 
-async def _run_job(batch: BatchRecord, job: JobRecord, semaphore: asyncio.Semaphore) -> None:
-    async with semaphore:
+    async with admission:
         try:
-            await _update_job(batch.id, job.id, status="submitting", api_status="submitting", error=None)
-            await _update_job(batch.id, job.id, status="processing", api_status="processing")
+            await _update_job(batch.id, job.id, status="processing", api_status="processing", error=None)
 
-            image_bytes, revised_prompt = await _create_image_edit(job, batch)
+            image_bytes, revised_prompt = await _create_image_edit(job, batch, on_rate_limited=_back_off)
 
             output_dir = OUTPUTS_DIR / batch.id
-            output_dir.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(output_dir.mkdir, parents=True, exist_ok=True)
             extension = "jpg" if batch.output_format == "jpeg" else batch.output_format
             output_path = output_dir / f"{job.id}.{extension}"
-            output_path.write_bytes(image_bytes)
+            await asyncio.to_thread(output_path.write_bytes, image_bytes)
 
             await _update_job(
                 batch.id,
@@ -226,6 +331,7 @@ async def _run_job(batch: BatchRecord, job: JobRecord, semaphore: asyncio.Semaph
                 api_status="completed",
                 revised_prompt=revised_prompt,
                 output_path=str(output_path),
+                output_ready=True,
             )
         except Exception as exc:  # noqa: BLE001
             await _update_job(
@@ -243,17 +349,36 @@ async def _process_batch(batch_id: str) -> None:
     if not batch:
         return
 
-    semaphore = asyncio.Semaphore(max(1, batch.concurrency))
+    admission = _Admission(batch.concurrency)
     async with state_lock:
         batch.status = "running"
-
-    tasks = [asyncio.create_task(_run_job(batch, job, semaphore)) for job in batch.jobs]
-    await asyncio.gather(*tasks)
+        batch.invalidate()
+
+    queue: asyncio.Queue[JobRecord] = asyncio.Queue()
+    for job in batch.jobs:
+        queue.put_nowait(job)
+
+    # A fixed pool of workers keeps pending tasks at O(concurrency); admission can still
+    # lower the effective limit below the worker count after rate limiting.
+    async def _worker() -> None:
+        while True:
+            job = await queue.get()
+            try:
+                await _run_job(batch, job, admission)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(_worker()) for _ in range(max(1, batch.concurrency))]
+    await queue.join()
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
 
     async with state_lock:
         final_batch = batches.get(batch_id)
         if final_batch:
             final_batch.recalculate_status()
+            final_batch.invalidate()
 
 
 def _sanitize_prompts(prompts_text: str) -> list[str]:
@@ -264,17 +389,50 @@ def _validate_base_name(base_name: str) -> str:
     cleaned = base_name.strip()
     if not cleaned:
         raise HTTPException(status_code=400, detail="Base name is required.")
-    if any(ch in cleaned for ch in r'<>:"/\|?*'):
+    if _INVALID_BASE_RE.search(cleaned):
         raise HTTPException(
             status_code=400,
             detail="Base name contains invalid filename characters (<>:\"/\\|?*).",
         )
     if cleaned.endswith(" ") or cleaned.endswith("."):
         raise HTTPException(status_code=400, detail="Base name cannot end with a space or period.")
-    cleaned = re.sub(r"\s+", " ", cleaned)
+    cleaned = _WS_RE.sub(" ", cleaned)
     return cleaned
 
 
+def _order_renames(plan: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    # Sources and targets are each unique, so the plan splits into chains and cycles.
+    # Chains are renamed tail-first; only cycles need a temporary name to break them.
+    targets = {os.path.normcase(old): new for old, new in plan if old != new}
+    names = {os.path.normcase(old): old for old, new in plan if old != new}
+    sources_by_target = {os.path.normcase(new): key for key, new in targets.items()}
+
+    ordered: list[tuple[str, str]] = []
+    pending = set(targets)
+    for key in list(targets):
+        if os.path.normcase(targets[key]) in targets:
+            continue
+        current: str | None = key
+        while current is not None:
+            ordered.append((names[current], targets[current]))
+            pending.discard(current)
+            current = sources_by_target.get(current)
+
+    for key in list(targets):
+        if key not in pending:
+            continue
+        temp_name = f".__tmp_rename_{secrets.token_hex(16)}.png"
+        ordered.append((names[key], temp_name))
+        pending.discard(key)
+        current = sources_by_target[key]
+        while current != key:
+            ordered.append((names[current], targets[current]))
+            pending.discard(current)
+            current = sources_by_target[current]
+        ordered.append((temp_name, targets[key]))
+    return ordered
+
+
 def _open_folder_picker() -> str:
     # Native dialog for local desktop use (works when the server runs on the same machine).
     try:
@@ -327,12 +485,11 @@ async def create_batch(
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY is not configured on the server.")
 
-    batch_id = uuid.uuid4().hex[:12]
+    batch_id = secrets.token_hex(6)
     upload_dir = UPLOADS_DIR / batch_id
-    upload_dir.mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(upload_dir.mkdir, parents=True, exist_ok=True)
 
-    saved_images: list[tuple[str, Path]] = []
-    for idx, upload in enumerate(images, start=1):
+    async def _persist(idx: int, upload: UploadFile) -> tuple[str, Path]:
         if not upload.filename:
             raise HTTPException(status_code=400, detail=f"Image {idx} is missing a filename.")
         content = await upload.read()
@@ -340,8 +497,12 @@ async def create_batch(
             raise HTTPException(status_code=400, detail=f"Image {idx} is empty.")
         safe_name = Path(upload.filename).name
         file_path = upload_dir / f"{idx:03d}_{safe_name}"
-        file_path.write_bytes(content)
-        saved_images.append((safe_name, file_path))
+        await asyncio.to_thread(file_path.write_bytes, content)
+        return safe_name, file_path
+
+    saved_images: list[tuple[str, Path]] = await asyncio.gather(
+        *[_persist(idx, upload) for idx, upload in enumerate(images, start=1)]
+    )
 
     jobs: list[JobRecord] = []
     seq = 1
@@ -349,7 +510,7 @@ async def create_batch(
         for prompt in prompts:
             jobs.append(
                 JobRecord(
-                    id=uuid.uuid4().hex[:10],
+                    id=secrets.token_hex(5),
                     batch_id=batch_id,
                     sequence=seq,
                     image_filename=image_filename,
@@ -364,6 +525,7 @@ async def create_batch(
         prompts=prompts,
         image_filenames=[name for name, _ in saved_images],
         jobs=jobs,
+        jobs_by_id={job.id: job for job in jobs},
         model=model.strip() or DEFAULT_MODEL,
         size=size.strip() or "1024x1024",
         quality=quality,
@@ -379,12 +541,12 @@ async def create_batch(
 
 
 @app.get("/api/batches/{batch_id}")
-async def get_batch(batch_id: str) -> dict[str, Any]:
+async def get_batch(batch_id: str) -> Response:
     async with state_lock:
         batch = batches.get(batch_id)
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found.")
-        return batch.to_dict()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found.")
+    return Response(content=batch.to_json(), media_type="application/json")
 
 
 @app.get("/api/batches/{batch_id}/jobs/{job_id}/download")
@@ -393,28 +555,26 @@ async def download_job_output(batch_id: str, job_id: str) -> FileResponse:
         batch = batches.get(batch_id)
         if not batch:
             raise HTTPException(status_code=404, detail="Batch not found.")
-        job = next((j for j in batch.jobs if j.id == job_id), None)
+        job = batch.jobs_by_id.get(job_id)
         if not job:
             raise HTTPException(status_code=404, detail="Job not found.")
         if not job.output_path:
             raise HTTPException(status_code=404, detail="Job output not ready.")
         output_path = Path(job.output_path)
+        sequence = job.sequence
+        image_filename = job.image_filename
         output_format = batch.output_format
 
     if not output_path.exists():
         raise HTTPException(status_code=404, detail="Output file is missing.")
 
     ext = "jpg" if output_format == "jpeg" else output_format
-    filename = f"{batch_id}_{job.sequence:03d}_{Path(job.image_filename).stem}.{ext}"
+    filename = f"{batch_id}_{sequence:03d}_{Path(image_filename).stem}.{ext}"
     media_type = f"image/{output_format}"
     return FileResponse(path=output_path, media_type=media_type, filename=filename)
 
 
-@app.post("/api/rename-pngs")
-async def rename_pngs(
-    folder_path: str = Form(...),
-    base_name: str = Form(...),
-) -> dict[str, Any]:
+def _rename_pngs_sync(folder_path: str, base_name: str) -> dict[str, Any]:
     target_dir = Path(folder_path.strip()).expanduser()
     validated_base = _validate_base_name(base_name)
 
@@ -423,16 +583,17 @@ async def rename_pngs(
     if not target_dir.is_dir():
         raise HTTPException(status_code=400, detail="Provided path is not a folder.")
 
-    png_files = sorted(
-        [p for p in target_dir.iterdir() if p.is_file() and p.suffix.lower() == ".png"],
-        key=lambda p: p.name.lower(),
-    )
-    if not png_files:
+    with os.scandir(target_dir) as it:
+        png_names = sorted(
+            (e.name for e in it if e.is_file(follow_symlinks=False) and e.name.lower().endswith(".png")),
+            key=str.lower,
+        )
+    if not png_names:
         raise HTTPException(status_code=400, detail="No .png files found in the selected folder.")
 
-    planned_names = [f"{validated_base}_{idx}.png" for idx in range(1, len(png_files) + 1)]
+    planned_names = [f"{validated_base}_{idx}.png" for idx in range(1, len(png_names) + 1)]
 
-    current_set = {p.name for p in png_files}
+    current_set = set(png_names)
     for new_name in planned_names:
         conflict_path = target_dir / new_name
         if conflict_path.exists() and new_name not in current_set:
@@ -441,22 +602,11 @@ async def rename_pngs(
                 detail=f"Cannot rename because target file already exists: {new_name}",
             )
 
-    # Two-phase rename avoids collisions (e.g. a.png -> b.png while b.png also exists in batch).
-    temp_paths: list[Path] = []
-    for source in png_files:
-        temp_name = f".__tmp_rename_{uuid.uuid4().hex}.png"
-        temp_path = target_dir / temp_name
-        source.rename(temp_path)
-        temp_paths.append(temp_path)
-
-    renamed: list[dict[str, str]] = []
+    plan = list(zip(png_names, planned_names))
+    renamed = [{"old_name": old_name, "new_name": new_name} for old_name, new_name in plan]
     try:
-        for idx, temp_path in enumerate(temp_paths, start=1):
-            new_name = f"{validated_base}_{idx}.png"
-            final_path = target_dir / new_name
-            original_name = png_files[idx - 1].name
-            temp_path.rename(final_path)
-            renamed.append({"old_name": original_name, "new_name": new_name})
+        for old_name, new_name in _order_renames(plan):
+            os.rename(target_dir / old_name, target_dir / new_name)
     except Exception as exc:  # noqa: BLE001
         raise HTTPException(status_code=500, detail=f"Rename failed: {exc}") from exc
 
@@ -468,6 +618,14 @@ async def rename_pngs(
     }
 
 
+@app.post("/api/rename-pngs")
+async def rename_pngs(
+    folder_path: str = Form(...),
+    base_name: str = Form(...),
+) -> dict[str, Any]:
+    return await asyncio.to_thread(_rename_pngs_sync, folder_path, base_name)
+
+
 @app.post("/api/select-folder")
 async def select_folder() -> dict[str, str]:
     try: